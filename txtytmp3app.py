@@ -1,12 +1,25 @@
+import asyncio
+import json
+import os
+import re
+import stat
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+import aiohttp
 import yaml
 from typing import Iterable
 from pathlib import Path
-from pytube import YouTube
+from urllib.parse import parse_qs, urlparse
+from pytube import YouTube, request
+from pytube.query import StreamQuery
 from pytube.streams import Stream
 from pytube.exceptions import RegexMatchError
 
 from textual import work, on
+from textual.timer import Timer
 from textual.worker import Worker
 from textual.app import App, ComposeResult
 from textual.containers import VerticalScroll, Horizontal, Vertical
@@ -23,30 +36,162 @@ from textual.widgets import (
 )
 from textual.widget import Widget
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+_HOME = Path.home()
+_HOME_POSIX = _HOME.as_posix()
+_CFG_PATH = Path(".cfg.json")
+_LEGACY_CFG_PATH = Path(".cfg.yaml")
+# Read once at import: os.umask() can only be queried by setting it.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+URL_DEBOUNCE = 0.3
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_BUFFER_SIZE = 64 * 1024
+DOWNLOAD_READ_TIMEOUT = 60
+# Same headers pytube sends for its own range requests.
+_DOWNLOAD_HEADERS = {"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"}
+PROGRESS_INTERVAL = 1 / 60
+MAX_IO_WORKERS = 4
+VIDEO_CACHE_SIZE = 8
+VIDEO_CACHE_TTL = 60 * 60
+VIDEO_CACHE_MARGIN = 5 * 60
+_URL_RE = re.compile(
+    r"^(?:https?://)?(?:www\.|m\.|music\.)?"
+    r"(?:youtube(?:-nocookie)?\.com/(?:watch\?(?:\S*&)?v=|shorts/|embed/|live/|v/)"
+    r"|youtu\.be/)"
+    r"(?P<id>[\w-]{11})"
+)
+
+
+def load_cfg(cfg_path: Path) -> dict:
+    """Parse the config at `cfg_path`, treating anything but an object as empty."""
+    with open(cfg_path, "r") as read:
+        try:
+            cfgs = json.load(read)
+        except json.JSONDecodeError:
+            return {}
+    return cfgs if isinstance(cfgs, dict) else {}
+
+
+def dump_cfg(cfg_path: Path, cfgs: dict) -> None:
+    """Atomically write `cfgs` to `cfg_path` as compact JSON."""
+    try:
+        mode = stat.S_IMODE(cfg_path.stat().st_mode)
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+    tmp = tempfile.NamedTemporaryFile(
+        "w", dir=cfg_path.parent, suffix=".tmp", delete=False
+    )
+    try:
+        with tmp:
+            os.fchmod(tmp.fileno(), mode)
+            tmp.write(json.dumps(cfgs, separators=(",", ":")))
+        os.replace(tmp.name, cfg_path)
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+
+
+def migrate_legacy_cfg() -> None:
+    """Convert a `.cfg.yaml` left by older versions into `.cfg.json`."""
+    if _CFG_PATH.is_file() or not _LEGACY_CFG_PATH.is_file():
+        return
+    with open(_LEGACY_CFG_PATH, "r") as read:
+        cfgs = yaml.load(read, Loader=SafeLoader) or {}
+    dump_cfg(_CFG_PATH, cfgs)
+    _LEGACY_CFG_PATH.unlink()
+
+
+def stream_expiry(tracks: StreamQuery) -> float:
+    """Return the epoch time after which the signed URLs in `tracks` are stale."""
+    expires = [
+        float(expire[0])
+        for expire in (parse_qs(urlparse(t.url).query).get("expire") for t in tracks)
+        if expire
+    ]
+    if not expires:
+        return time.time() + VIDEO_CACHE_TTL
+    return min(expires) - VIDEO_CACHE_MARGIN
+
 
 class Download(Button):
     stream: Stream = None
     location: Path | None = None
+    _last_percent: int = -1
+    _last_post: float = 0.0
 
     class DownloadProgress(Message):
         def __init__(self, remaining) -> None:
             self.remaining = remaining
             super().__init__()
 
-    def logged_on_progress(self, default_on_progress, chunk, handler, remaining):
-        self.log("On Progress", remaining)
-        self.post_message(self.DownloadProgress(remaining))
-        default_on_progress(chunk, handler, remaining)
-
-    @work(exclusive=True, thread=True)
+    class DownloadFailed(Message):
+        pass
+
+    def report_progress(self, remaining: int) -> None:
+        filesize = self.stream.filesize or 1
+        percent = (filesize - remaining) * 100 // filesize
+        now = time.monotonic()
+        if remaining == 0 or (
+            percent != self._last_percent
+            and now - self._last_post > PROGRESS_INTERVAL
+        ):
+            self._last_percent = percent
+            self._last_post = now
+            self.log("On Progress", remaining)
+            self.post_message(self.DownloadProgress(remaining))
+
+    @work(exclusive=True)
     async def on_button_pressed(self, event: Button.Pressed) -> None:
         if self.stream is not None:
-            default_on_progress = self.stream.on_progress
-            self.stream.on_progress = partial(
-                self.logged_on_progress, default_on_progress
-            )
+            self._last_percent = -1
+            self._last_post = 0.0
             self.label = "Downloading..."
-            self.stream.download(output_path=self.location, skip_existing=False)
+            file_path = Path(self.stream.get_file_path(output_path=self.location))
+            url = self.stream.url
+            filesize = self.stream.filesize
+            downloaded = 0
+            timeout = aiohttp.ClientTimeout(total=None, sock_read=DOWNLOAD_READ_TIMEOUT)
+            completed = False
+            try:
+                async with aiohttp.ClientSession(
+                    headers=_DOWNLOAD_HEADERS, timeout=timeout
+                ) as session:
+                    with open(file_path, "wb", buffering=DOWNLOAD_BUFFER_SIZE) as f:
+                        # Fetch in pytube-sized ranges; YouTube throttles
+                        # single unranged requests.
+                        while downloaded < filesize:
+                            start = downloaded
+                            stop = min(start + request.default_range_size, filesize) - 1
+                            async with session.get(
+                                f"{url}&range={start}-{stop}"
+                            ) as response:
+                                response.raise_for_status()
+                                async for chunk in response.content.iter_chunked(
+                                    DOWNLOAD_CHUNK_SIZE
+                                ):
+                                    f.write(chunk)
+                                    downloaded += len(chunk)
+                                    self.report_progress(max(filesize - downloaded, 0))
+                            if downloaded == start:
+                                raise aiohttp.ClientPayloadError(
+                                    f"Empty response for range {start}-{stop}"
+                                )
+                completed = True
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                self.log("Download failed", e)
+                self.label = "Error. Click to retry"
+                self.post_message(self.DownloadFailed())
+                return
+            finally:
+                # Also runs when the worker is cancelled (exit or a new press).
+                if not completed:
+                    file_path.unlink(missing_ok=True)
             self.label = "Done"
         else:
             self.label = "Error. Click to retry"
@@ -66,9 +211,14 @@ class StreamSelect(Select):
 
 class FilteredDirectoryTree(DirectoryTree):
     def filter_paths(self, paths: Iterable[Path]) -> Iterable[Path]:
-        return [
-            path for path in paths if (not path.name.startswith(".") and path.is_dir())
-        ]
+        for path in paths:
+            if path.name.startswith("."):
+                continue
+            try:
+                if path.is_dir():
+                    yield path
+            except OSError:
+                continue
 
 
 class DownloadLocation(Widget):
@@ -84,7 +234,7 @@ class DownloadLocation(Widget):
         if default_loc is not None:
             self.default_loc = Path(default_loc)
         else:
-            self.default_loc = Path.home()
+            self.default_loc = _HOME
         self.selected_path = self.default_loc
         super().__init__(
             *children, name=name, id=id, classes=classes, disabled=disabled
@@ -105,17 +255,16 @@ class DownloadLocation(Widget):
                 Button(label="Set as default", id="defaultloc"),
                 classes="container",
             )
-            yield FilteredDirectoryTree(Path.home(), id="dirtree")
+            yield FilteredDirectoryTree(_HOME, id="dirtree")
 
-    @work(exclusive=True, thread=True)
+    @work(exclusive=True)
     @on(Button.Pressed)
-    def write_default_loc(self, event: Button.Pressed):
-        cfg_path = Path(".cfg.yaml")
-        cfgs = {}
-        if cfg_path.is_file():
-            cfgs = yaml.safe_load(cfg_path.read_text())
+    async def write_default_loc(self, event: Button.Pressed):
+        cfgs = self.app.cfgs
         cfgs["download_loc"] = self.selected_path.as_posix()
-        cfg_path.write_text(yaml.safe_dump(cfgs))
+        await asyncio.get_running_loop().run_in_executor(
+            self.app.cfg_executor, dump_cfg, _CFG_PATH, dict(cfgs)
+        )
 
     @on(Switch.Changed)
     async def toggle_exp_hide(self, event: Switch.Changed):
@@ -143,13 +292,24 @@ class YT2MP3(App):
     video = None
     path = "./"
     cfgs = None
+    executor: ThreadPoolExecutor
+    cfg_executor: ThreadPoolExecutor
+    _url_debounce: Timer | None = None
+    _last_meta: tuple[str, str, int] | None = None
+    _video_cache: OrderedDict[
+        str, tuple[YouTube, StreamQuery, tuple[str, str, int], float]
+    ]
+    _results: Markdown
+    _tracks: StreamSelect
+    _download: Download
+    _dprog: ProgressBar
 
     def parse_config(self):
-        cfg_path = Path(".cfg.yaml")
-        cfgs = {"download_loc": Path.home().as_posix()}
+        cfg_path = _CFG_PATH
+        cfgs = {"download_loc": _HOME_POSIX}
+        migrate_legacy_cfg()
         if cfg_path.is_file():
-            with open(cfg_path, "r") as read:
-                cfgs.update(yaml.safe_load(read) or {})
+            cfgs.update(load_cfg(cfg_path))
         self.cfgs = cfgs
 
     def compose(self) -> ComposeResult:
@@ -165,40 +325,67 @@ class YT2MP3(App):
 
     def on_mount(self) -> None:
         """Called when app starts."""
-        self.query_one("#tracks", StreamSelect).display = False
-        self.query_one("#dprog", ProgressBar).display = False
+        self.executor = ThreadPoolExecutor(max_workers=MAX_IO_WORKERS)
+        # Single worker so config writes land on disk in the order they were made.
+        self.cfg_executor = ThreadPoolExecutor(max_workers=1)
+        self._video_cache = OrderedDict()
+        self._results = self.query_one("#results", Markdown)
+        self._tracks = self.query_one("#tracks", StreamSelect)
+        self._download = self.query_one("#download", Download)
+        self._dprog = self.query_one("#dprog", ProgressBar)
+        with self.batch_update():
+            self._tracks.display = False
+            self._dprog.display = False
         self.query_one("#url", Input).focus()
         self.change_download_location(DownloadLocation.SelectedPath(self.cfgs["download_loc"]))
 
+    def on_unmount(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.cfg_executor.shutdown(wait=False)
+
     @on(Input.Changed)
     async def url_changed(self, message: Input.Changed) -> None:
-        self.query_one("#results", Markdown).update("Searching...")
-        if message.value:
-            self.find_video(message.value)
+        if self._url_debounce is not None:
+            self._url_debounce.stop()
+            self._url_debounce = None
+        self.workers.cancel_group(self, "find_video")
+        url = message.value.strip()
+        match = _URL_RE.match(url)
+        if match:
+            if self.video is None or self.video.video_id != match.group("id"):
+                self.video = None
+                self._last_meta = None
+                with self.batch_update():
+                    self._download.display = False
+                    self._tracks.display = False
+                    self._results.update("Searching...")
+            self._url_debounce = self.set_timer(
+                URL_DEBOUNCE, partial(self.find_video, url)
+            )
         else:
-            self.query_one("#results", Markdown).update("")
+            self.clear_results()
 
     @on(Switch.Changed)
     def focus_url(self, event: Switch.Changed):
         if not event.value:
-            self.query_one("#results", Markdown).focus()
+            self._results.focus()
 
     @on(DownloadLocation.SelectedPath)
     def change_download_location(self, event: DownloadLocation.SelectedPath):
-        self.query_one("#download", Download).location = event.selected_path
+        self._download.location = event.selected_path
 
     @on(StreamSelect.Selected)
     def selected_stream(self, event: StreamSelect.Selected) -> None:
         self.log("select changed", str(event.stream))
-        self.query_one("#download").stream = event.stream
-        self.query_one("#download").label = "Download"
+        self._download.stream = event.stream
+        self._download.label = "Download"
         self.log("Filesize", event.stream.filesize)
-        self.query_one("#dprog", ProgressBar).total = event.stream.filesize
-        self.query_one("#dprog", ProgressBar).progress = 0
+        self._dprog.total = event.stream.filesize
+        self._dprog.progress = 0
 
     @on(Download.DownloadProgress)
     def download_progress(self, event: Download.DownloadProgress) -> None:
-        dprog = self.query_one("#dprog", ProgressBar)
+        dprog = self._dprog
         advance = (dprog.total - event.remaining) - dprog.progress
         dprog.advance(advance)
         self.log(
@@ -210,40 +397,77 @@ class YT2MP3(App):
             advance,
         )
 
-    @work(exclusive=True, thread=True)
-    async def find_video(self, url: str) -> None:
-        try:
-            self.video = YouTube(url)
-        except RegexMatchError:
-            self.video = None
+    @on(Download.DownloadFailed)
+    def download_failed(self, event: Download.DownloadFailed) -> None:
+        # The stream URLs may have expired; look the video up again on retry.
         if self.video is not None:
-            self.fill_audio_tracks()
-            markdown = self.make_word_markdown()
-            self.query_one("#download", Button).display = True
-            self.query_one("#tracks", StreamSelect).display = True
-            self.query_one("#dprog", ProgressBar).display = True
-        else:
-            markdown = ""
-            self.query_one("#download", Button).display = False
-            self.query_one("#tracks", StreamSelect).display = False
-        self.query_one("#results", Markdown).update(markdown)
+            self._video_cache.pop(self.video.video_id, None)
 
-    def fill_audio_tracks(self):
-        tracks = self.video.streams.filter(only_audio=True)
+    @work(exclusive=True, group="find_video")
+    async def find_video(self, url: str) -> None:
+        match = _URL_RE.match(url)
+        if not match:
+            self.clear_results()
+            return
+        video_id = match.group("id")
+        cached = self._video_cache.get(video_id)
+        if cached is not None and cached[3] <= time.time():
+            del self._video_cache[video_id]
+            cached = None
+        if cached is not None:
+            self._video_cache.move_to_end(video_id)
+            video, tracks, meta, _ = cached
+        else:
+            loop = asyncio.get_running_loop()
+            try:
+                video = await loop.run_in_executor(self.executor, YouTube, url)
+            except RegexMatchError:
+                self.clear_results()
+                return
+            # Both read pytube's lazy, unlocked vid_info; fetching the streams
+            # first fills it, so the metadata read after it is free.
+            tracks = await loop.run_in_executor(self.executor, self.audio_tracks, video)
+            meta = await loop.run_in_executor(self.executor, self.video_meta, video)
+            self._video_cache[video_id] = (video, tracks, meta, stream_expiry(tracks))
+            if len(self._video_cache) > VIDEO_CACHE_SIZE:
+                self._video_cache.popitem(last=False)
+        self.video = video
+        with self.batch_update():
+            self.fill_audio_tracks(tracks)
+            self._download.display = True
+            self._tracks.display = True
+            self._dprog.display = True
+            if meta != self._last_meta:
+                self._last_meta = meta
+                self._results.update(self.make_word_markdown(meta))
+
+    def clear_results(self) -> None:
+        self.video = None
+        self._last_meta = None
+        with self.batch_update():
+            self._download.display = False
+            self._tracks.display = False
+            self._results.update("")
+
+    def audio_tracks(self, video: YouTube) -> StreamQuery:
+        return video.streams.filter(only_audio=True)
+
+    def fill_audio_tracks(self, tracks: StreamQuery):
         self.log(tracks)
-        tracks_w = self.query_one("#tracks", Select)
-        tracks_w.set_options((str(t), t) for t in tracks)
-        tracks_w.value = tracks[0]
-        self.post_message(StreamSelect.Selected(tracks[0]))
+        tracks_w = self._tracks
+        options = [(str(t), t) for t in tracks]
+        tracks_w.set_options(options)
+        first = tracks[0]
+        tracks_w.value = first
+        self.post_message(StreamSelect.Selected(first))
+
+    def video_meta(self, video: YouTube) -> tuple[str, str, int]:
+        return video.title, video.author, video.length
 
-    def make_word_markdown(self) -> str:
+    def make_word_markdown(self, meta: tuple[str, str, int]) -> str:
         """Convert the results in to markdown."""
-        mkdown = f"""
-- **Title**: {self.video.title}
-- **Channel**: {self.video.author}
-- **Length**: {self.video.length}
-        """
-        return mkdown
+        title, author, length = meta
+        return f"- **Title**: {title}\n- **Channel**: {author}\n- **Length**: {length}"
 
 
 if __name__ == "__main__":